@@ -1,22 +1,77 @@
-from collections import OrderedDict
-import copy
+from bisect import bisect_left
 from itertools import chain
-import operator
-import textwrap
-from difflib import SequenceMatcher
 import json
 from pathlib import Path
-from hashlib import sha1
+import hashlib
+from hashlib import blake2b
 
 from rich.text import Text
 from rich.table import Table
 
+try:
+    # C implementation of difflib's matcher, same results but much faster
+    from cdifflib import CSequenceMatcher as SequenceMatcher
+except ImportError:
+    from difflib import SequenceMatcher
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from cyoa.tools.lib import *
 
 
+def dump_canonical(value) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+        except orjson.JSONEncodeError:
+            # Values orjson can't encode (e.g. integers beyond 64 bits)
+            pass
+
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def file_hash(path: Path):
+    with path.open(mode='rb') as fd:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(fd, 'sha1').digest()
+
+        # Python < 3.11
+        digest = hashlib.sha1()
+        while chunk := fd.read(1 << 16):
+            digest.update(chunk)
+        return digest.digest()
+
+
+def same_file_contents(path_a: Path, path_b: Path):
+    if not path_a.exists() or not path_b.exists():
+        return False
+
+    # Files of different sizes differ, don't read them just to find out
+    if path_a.stat().st_size != path_b.stat().st_size:
+        return False
+
+    return file_hash(path_a) == file_hash(path_b)
+
+
+# Hashes memoized by object identity, the hashed value is kept alive alongside
+# so its id can't be reused. Only valid as long as the values aren't mutated.
+_hash_cache: dict[int, tuple[object, str]] = {}
+
+
 def obj_hash(value):
-    value_ser = json.dumps(value, sort_keys=True, indent=0)
-    return sha1(value_ser.encode('utf-8')).hexdigest()
+    if (cached := _hash_cache.get(id(value))) is not None:
+        return cached[1]
+
+    value_hash = blake2b(dump_canonical(value), digest_size=16).hexdigest()
+    _hash_cache[id(value)] = (value, value_hash)
+    return value_hash
+
+
+def clear_hash_cache():
+    _hash_cache.clear()
 
 
 def default_delete_item(seq_a):
@@ -32,28 +87,122 @@ def default_summary(equal_count, replace_count, delete_count, insert_count):
         f"{equal_count=}, {replace_count=}, {delete_count=}, {insert_count=}")
 
 
+def hash_objects(seq):
+    return [
+        (obj["id"], obj_hash(obj))
+        for obj in seq
+    ]
+
+
+def get_opcodes(seq_a_hash: list, seq_b_hash: list):
+    # Object ids are unique, the popularity heuristic only degrades the diff
+    seq_match = SequenceMatcher(a=seq_a_hash, b=seq_b_hash, autojunk=False)
+    return seq_match.get_opcodes()
+
+
+def longest_ordered_pairs(pairs: list):
+    """
+    Longest subsequence of (a_idx, b_idx) pairs, sorted by b_idx, in which
+    a_idx is increasing as well.
+    """
+    tails = []  # Smallest a_idx ending a subsequence of each length
+    tails_pos = []
+    prev_pos = [None] * len(pairs)
+    for pos, (a_idx, _) in enumerate(pairs):
+        length = bisect_left(tails, a_idx)
+        if length > 0:
+            prev_pos[pos] = tails_pos[length - 1]
+
+        if length == len(tails):
+            tails.append(a_idx)
+            tails_pos.append(pos)
+        else:
+            tails[length] = a_idx
+            tails_pos[length] = pos
+
+    result = []
+    pos = tails_pos[-1] if tails_pos else None
+    while pos is not None:
+        result.append(pairs[pos])
+        pos = prev_pos[pos]
+
+    result.reverse()
+    return result
+
+
+def get_opcodes_by_id(seq_a_hash: list, seq_b_hash: list):
+    a_index = {item_id: a_idx for a_idx, (item_id, _) in enumerate(seq_a_hash)}
+    b_ids = [item_id for item_id, _ in seq_b_hash]
+    if len(a_index) != len(seq_a_hash) or len(set(b_ids)) != len(b_ids):
+        # Ids aren't unique, can't align on them
+        return get_opcodes(seq_a_hash, seq_b_hash)
+
+    # Items present in both sequences that kept their relative order are
+    # matched, the other shared items were moved (deleted and re-inserted)
+    anchors = longest_ordered_pairs([
+        (a_index[item_id], b_idx)
+        for b_idx, item_id in enumerate(b_ids)
+        if item_id in a_index
+    ])
+
+    opcodes = []
+    a_pos, b_pos = 0, 0
+    prev_anchor = None
+    for a_idx, b_idx in chain(anchors, [(len(seq_a_hash), len(seq_b_hash))]):
+        # Unmatched items between two anchors
+        if a_pos < a_idx or b_pos < b_idx:
+            if a_pos < a_idx and b_pos < b_idx:
+                opcodes.append(('replace', a_pos, a_idx, b_pos, b_idx))
+            elif a_pos < a_idx:
+                opcodes.append(('delete', a_pos, a_idx, b_pos, b_idx))
+            else:
+                opcodes.append(('insert', a_pos, a_idx, b_pos, b_idx))
+            prev_anchor = None
+
+        if a_idx == len(seq_a_hash):
+            break
+
+        # Matched item, extend the previous opcode if it was the same kind
+        tag = 'equal' if seq_a_hash[a_idx] == seq_b_hash[b_idx] else 'replace'
+        if prev_anchor == tag:
+            _, a_start, _, b_start, _ = opcodes.pop()
+            opcodes.append((tag, a_start, a_idx + 1, b_start, b_idx + 1))
+        else:
+            opcodes.append((tag, a_idx, a_idx + 1, b_idx, b_idx + 1))
+        prev_anchor = tag
+        a_pos, b_pos = a_idx + 1, b_idx + 1
+
+    return opcodes
+
+
 def diff_sequence(seq_a: list, seq_b: list, update_item,
                   delete_item=default_delete_item,
                   insert_item=default_insert_item,
-                  summary=default_summary):
-    def hash_objects(seq):
-        return [
-            (obj["id"], obj_hash(obj))
-            for obj in seq
-        ]
+                  summary=default_summary,
+                  seq_a_hash=None,
+                  seq_b_hash=None):
+    if seq_a_hash is None:
+        seq_a_hash = hash_objects(seq_a)
+    if seq_b_hash is None:
+        seq_b_hash = hash_objects(seq_b)
+
+    if seq_a_hash == seq_b_hash:
+        # Identical sequences, difflib would yield a single 'equal' opcode
+        summary(1 if len(seq_a) > 0 else 0, 0, 0, 0)
+        return list(seq_a)
 
-    seq_a_hash = hash_objects(seq_a)
-    seq_b_hash = hash_objects(seq_b)
+    opcodes = get_opcodes_by_id(seq_a_hash, seq_b_hash)
 
-    seq_match = SequenceMatcher(a=seq_a_hash, b=seq_b_hash)
     equal_count = 0
     replace_count = 0
     delete_count = 0
     insert_count = 0
     seq_out = []
-    for tag, a_start, a_end, b_start, b_end in seq_match.get_opcodes():
+    seq_out_extend = seq_out.extend
+    seq_out_append = seq_out.append
+    for tag, a_start, a_end, b_start, b_end in opcodes:
         if tag == 'equal':
-            seq_out.extend(seq_a[a_start:a_end])
+            seq_out_extend(seq_a[a_start:a_end])
             equal_count += 1  # No changes, skip
         elif tag == 'replace' and a_end - a_start == b_end - b_start:
             # Same number of items get updated
@@ -61,43 +210,40 @@ def diff_sequence(seq_a: list, seq_b: list, update_item,
             new_rows = seq_b[b_start:b_end]
             for old_row, new_row in zip(old_rows, new_rows):
                 item_data = update_item(old_row, new_row)
-                seq_out.append(item_data)
+                seq_out_append(item_data)
 
             replace_count += a_end - a_start
         elif tag == 'replace' and a_end - a_start != b_end - b_start:
             # List shrunk
-            old_rows = list(map(operator.itemgetter(0),
-                                seq_a_hash[a_start:a_end]))
-            new_rows = list(map(operator.itemgetter(0),
-                                seq_b_hash[b_start:b_end]))
-            updated_ids = set(old_rows) & set(new_rows)
-
             old_rows_items = {item['id']: item for item in seq_a[a_start:a_end]}
+            new_ids = {item['id'] for item in seq_b[b_start:b_end]}
+            updated_ids = old_rows_items.keys() & new_ids
+
             for old_row in seq_a[a_start:a_end]:
                 if old_row['id'] in updated_ids:
                     continue
 
                 del_items = delete_item([old_row])
-                seq_out.extend(del_items)
+                seq_out_extend(del_items)
                 delete_count += 1 - len(del_items)
 
             for new_row in seq_b[b_start:b_end]:
                 if (row_id := new_row['id']) in updated_ids:
                     item_data = update_item(old_rows_items[row_id], new_row)
-                    seq_out.append(item_data)
+                    seq_out_append(item_data)
                     replace_count += 1
                 else:
                     ins_items = insert_item([new_row])
-                    seq_out.extend(ins_items)
+                    seq_out_extend(ins_items)
                     insert_count += len(ins_items)
         elif tag == 'delete':
             # Allow the delete function to keep some imtems
             del_res = delete_item(seq_a[a_start:a_end])
-            seq_out.extend(del_res)
+            seq_out_extend(del_res)
             delete_count += (a_end - a_start) - len(del_res)
         elif tag == 'insert':
             ins_res = insert_item(seq_b[b_start:b_end])
-            seq_out.extend(ins_res)
+            seq_out_extend(ins_res)
             insert_count += len(ins_res)
 
     summary(equal_count, replace_count, delete_count, insert_count)
@@ -116,6 +262,11 @@ SPECIAL_KEYS = (
 # Theses keys shouldn't be modified
 IGNORE_KEYS = ('currentChoices', 'isActive', 'isEditModeOn')
 
+# Set versions for membership tests, the tuples define the display order
+IMPORTANT_KEYS_SET = frozenset(IMPORTANT_KEYS)
+SPECIAL_KEYS_SET = frozenset(SPECIAL_KEYS)
+IGNORE_KEYS_SET = frozenset(IGNORE_KEYS)
+
 SPECIAL_DISPLAY = {
     'scores': lambda scores: Text.assemble(*intercalate("\n", [
         Text.assemble(score['beforeText'], " ", score['value'], " ", score['afterText'],
@@ -142,61 +293,85 @@ def intercalate(sep, items):
         yield item
 
 
-def update_dict(old_data: dict, new_data: dict):
-    merged_keys = set(old_data.keys() | new_data.keys())
-    rest_keys = list(sorted(merged_keys - set(SPECIAL_KEYS)))
-
-    def show_value(value, key=None):
-        if key in SPECIAL_DISPLAY:
-            return SPECIAL_DISPLAY[key](value)
-        elif isinstance(value, str) and len(value) == 0:
-            return Text('N/A', style="grey50")
-        elif isinstance(value, str):
-            return Text(value[:60] + "..." if len(value) > 60 else value)
-        elif isinstance(value, list) and len(value) == 0:
-            return Text("[]")
-        elif isinstance(value, list):
-            return Text.assemble(*intercalate("\n", [
-                show_value(val) for val in value
-            ]))
-        elif isinstance(value, dict):
-            return Text(json.dumps(value, sort_keys=True, indent=2))
-        else:
-            return Text(str(value))
+def show_value(value, key=None):
+    if key in SPECIAL_DISPLAY:
+        return SPECIAL_DISPLAY[key](value)
+    elif isinstance(value, str) and len(value) == 0:
+        return Text('N/A', style="grey50")
+    elif isinstance(value, str):
+        return Text(value[:60] + "..." if len(value) > 60 else value)
+    elif isinstance(value, list) and len(value) == 0:
+        return Text("[]")
+    elif isinstance(value, list):
+        return Text.assemble(*intercalate("\n", [
+            show_value(val) for val in value
+        ]))
+    elif isinstance(value, dict):
+        return Text(json.dumps(value, sort_keys=True, indent=2))
+    else:
+        return Text(str(value))
+
+
+def show_dict(data: dict):
+    # Same output as update_dict(data, data) without walking every key
+    diff_table = Table(show_header=False, show_lines=False)
+    for key in IMPORTANT_KEYS:
+        if key in data:
+            diff_table.add_row(key,
+                               show_value(data[key], key),
+                               Text("==", style="grey50"))
+
+    console.log(diff_table)
+
+
+def update_dict(old_data: dict, new_data: dict, show_diff: bool = True):
+    if old_data is new_data or old_data == new_data:
+        # Nothing to merge, only the important keys would be shown
+        if show_diff:
+            show_dict(old_data)
+        return old_data
+
+    merged_keys = old_data.keys() | new_data.keys()
+    rest_keys = list(sorted(merged_keys - SPECIAL_KEYS_SET))
 
     result_dict = {}
     result_changed = False
-    diff_table = Table(show_header=False, show_lines=False)
+    diff_table = Table(show_header=False, show_lines=False) if show_diff else None
     for key in chain(SPECIAL_KEYS, rest_keys):
-        if key in IGNORE_KEYS:
+        if key in IGNORE_KEYS_SET:
             # Don't change an ignored key
             result_dict[key] = old_data[key] 
         elif key in old_data and key in new_data and old_data[key] != new_data[key]:
-            diff_table.add_row(key,
-                               show_value(old_data[key], key),
-                               show_value(new_data[key], key))
+            if show_diff:
+                diff_table.add_row(key,
+                                   show_value(old_data[key], key),
+                                   show_value(new_data[key], key))
             result_dict[key] = new_data[key]
             result_changed |= True
         elif key in old_data and key not in new_data:
-            diff_table.add_row(key,
-                               show_value(old_data[key], key),
-                               Text("N/A", style="grey50"))
+            if show_diff:
+                diff_table.add_row(key,
+                                   show_value(old_data[key], key),
+                                   Text("N/A", style="grey50"))
             result_changed |= True
         elif key not in old_data and key in new_data:
-            diff_table.add_row(key,
-                               Text("N/A", style='grey50'),
-                               show_value(new_data[key], key))
+            if show_diff:
+                diff_table.add_row(key,
+                                   Text("N/A", style='grey50'),
+                                   show_value(new_data[key], key))
             result_dict[key] = new_data[key]
             result_changed |= True
-        elif key in IMPORTANT_KEYS and key in old_data:
-            diff_table.add_row(key,
-                               show_value(old_data[key], key),
-                               Text("==", style="grey50"))
+        elif key in IMPORTANT_KEYS_SET and key in old_data:
+            if show_diff:
+                diff_table.add_row(key,
+                                   show_value(old_data[key], key),
+                                   Text("==", style="grey50"))
             result_dict[key] = old_data[key]
         elif key in old_data:
             result_dict[key] = old_data[key]
 
-    console.log(diff_table)
+    if show_diff:
+        console.log(diff_table)
     if result_changed:
         return result_dict
     else:
@@ -215,6 +390,9 @@ class ProjectMergeTool(ToolBase, ProjectUtilsMixin):
                             type=Path, required=True)
         parser.add_argument('--write', dest='write',
                             action='store_true')
+        parser.add_argument('--verbose', dest='verbose',
+                            action='store_true',
+                            help='Show the diff tables even when not writing to a terminal')
         
         parser.add_argument('--skip-rows', dest='skip_rows',
                             nargs='+', action='extend',
@@ -231,37 +409,54 @@ class ProjectMergeTool(ToolBase, ProjectUtilsMixin):
                             default=[])
 
     def run(self, args):
+        if same_file_contents(args.project_file, args.patch):
+            console.log("Project and patch are identical, no changes")
+            if args.write:
+                # Still rewrite the project in the canonical format
+                self._load_project(args.project_file)
+                self._save_project(args.project_file)
+            return
+
         self._load_project(args.project_file)
         patch_project = self._load_file(args.patch)
 
+        skip_rows = frozenset(args.skip_rows)
+        only_rows = frozenset(args.only_rows)
+        skip_objs = frozenset(args.skip_objs)
+        only_objs = frozenset(args.only_objs)
+        # Rendering the diff tables dominates the run time, skip them when
+        # the output isn't read interactively
+        show_diff = args.verbose or console.is_terminal
+
         def update_object(old_obj, new_obj):
             console.log(f"  Updated Item ({old_obj['id']}): {old_obj['title']}",
                         style="orange1")
-            if old_obj['id'] in args.skip_objs:
+            if old_obj['id'] in skip_objs:
                 console.log(f"    Skipped (in exclusion list)", style="dark_slate_gray1 italic")
                 return old_obj
             
-            if len(args.only_rows) > 0 and old_obj['id'] not in args.only_objs:
+            if only_objs and old_obj['id'] not in only_objs:
                 console.log(f"    Skipped (not in inclusion list)", style="dark_slate_gray1 italic")
                 return old_obj
             
-            return update_dict(old_obj, new_obj)
+            return update_dict(old_obj, new_obj, show_diff=show_diff)
 
         def delete_object(items):
             excluded_rows = []
             for item in items:
                 console.log(f"  Deleted Item ({item['id']}): {item['title']}", style="red")
-                if item['id'] in args.skip_objs:
+                if item['id'] in skip_objs:
                     console.log(f"    Skipped (in exclusion list)", style="dark_slate_gray1 italic")
                     excluded_rows.append(item)
                     continue
                 
-                if len(args.only_objs) > 0 and item['id'] not in args.only_objs:
+                if only_objs and item['id'] not in only_objs:
                     console.log(f"    Skipped (not in inclusion list)", style="dark_slate_gray1 italic")
                     excluded_rows.append(item)
                     continue
 
-                update_dict(item, item)
+                if show_diff:
+                    show_dict(item)
 
             return excluded_rows
 
@@ -269,15 +464,16 @@ class ProjectMergeTool(ToolBase, ProjectUtilsMixin):
             included_rows = []
             for item in new_items:
                 console.log(f"  Inserted Item ({item['id']}): {item['title']}", style="green")
-                if item['id'] in args.skip_objs:
+                if item['id'] in skip_objs:
                     console.log(f"  Skipped (in exclusion list)", style="dark_slate_gray1 italic")
                     continue
                 
-                if len(args.only_objs) > 0 and item['id'] not in args.only_objs:
+                if only_objs and item['id'] not in only_objs:
                     console.log(f"  Skipped (not in inclusion list)", style="dark_slate_gray1 italic")
                     continue
 
-                update_dict(item, item)
+                if show_diff:
+                    show_dict(item)
                 included_rows.append(item)
                 
             return included_rows
@@ -292,33 +488,40 @@ class ProjectMergeTool(ToolBase, ProjectUtilsMixin):
 
         def update_row(old_row, new_row):
             console.log(f"Updated Row ({old_row['id']}): {old_row['title']}", style="orange1")
-            if old_row['id'] in args.skip_rows:
+            if old_row['id'] in skip_rows:
                 console.log(f"  Skipped (in exclusion list)", style="dark_slate_gray1 italic")
                 return old_row
             
-            if len(args.only_rows) > 0 and old_row['id'] not in args.only_rows:
+            if only_rows and old_row['id'] not in only_rows:
                 console.log(f"  Skipped (not in inclusion list)", style="dark_slate_gray1 italic")
                 return old_row
             
-            old_objects = old_row.pop("objects", [])
-            new_objects = new_row.pop("objects", [])
+            # Don't mutate the rows, their hashes are cached
+            old_objects = old_row.get("objects", [])
+            new_objects = new_row.get("objects", [])
+            old_data = {key: value for key, value in old_row.items() if key != "objects"}
+            new_data = {key: value for key, value in new_row.items() if key != "objects"}
 
             # Handle updated properties
-            if obj_hash(old_row) != obj_hash(new_row):
+            if old_data != new_data:
                 console.log("  Updated Row Data", style="orange1")
-                updated_row = update_dict(old_row, new_row)
+                updated_row = update_dict(old_data, new_data, show_diff=show_diff)
             else:
-                updated_row = old_row
+                updated_row = old_data
 
             # Handle updated objects
-            if obj_hash(old_objects) != obj_hash(new_objects):
+            old_objects_hash = hash_objects(old_objects)
+            new_objects_hash = hash_objects(new_objects)
+            if old_objects_hash != new_objects_hash:
                 updated_objects = diff_sequence(
                     old_objects,
                     new_objects,
                     update_item=update_object,
                     delete_item=delete_object,
                     insert_item=insert_object,
-                    summary=objects_summary
+                    summary=objects_summary,
+                    seq_a_hash=old_objects_hash,
+                    seq_b_hash=new_objects_hash
                 )
                 updated_row["objects"] = updated_objects
             else:
@@ -330,17 +533,18 @@ class ProjectMergeTool(ToolBase, ProjectUtilsMixin):
             excluded_rows = []
             for row in rows:
                 console.log(f"Deleted Row ({row['id']}): {row['title']}", style="red")
-                if row['id'] in args.skip_rows:
+                if row['id'] in skip_rows:
                     console.log(f"  Skipped (in exclusion list)", style="dark_slate_gray1 italic")
                     excluded_rows.append(row)
                     continue
                 
-                if len(args.only_rows) > 0 and row['id'] not in args.only_rows:
+                if only_rows and row['id'] not in only_rows:
                     console.log(f"  Skipped (not in inclusion list)", style="dark_slate_gray1 italic")
                     excluded_rows.append(row)
                     continue
                 
-                update_dict(row, row)
+                if show_diff:
+                    show_dict(row)
 
             return excluded_rows
 
@@ -348,15 +552,16 @@ class ProjectMergeTool(ToolBase, ProjectUtilsMixin):
             included_rows = []
             for row in new_rows:
                 console.log(f"Inserted Row ({row['id']}): {row['title']}", style="green")
-                if row['id'] in args.skip_rows:
+                if row['id'] in skip_rows:
                     console.log(f"  Skipped (in exclusion list)", style="dark_slate_gray1 italic")
                     continue
                 
-                if len(args.only_rows) > 0 and row['id'] not in args.only_rows:
+                if only_rows and row['id'] not in only_rows:
                     console.log(f"  Skipped (not in inclusion list)", style="dark_slate_gray1 italic")
                     continue
 
-                update_dict(row, row)
+                if show_diff:
+                    show_dict(row)
                 included_rows.append(row)
 
             return included_rows
@@ -369,14 +574,17 @@ class ProjectMergeTool(ToolBase, ProjectUtilsMixin):
             if insert_count > 0:
                 console.log(f"Total Inserted Rows: {insert_count}")
 
-        new_rows = diff_sequence(
-            self.project["rows"],
-            patch_project["rows"],
-            update_item=update_row,
-            delete_item=delete_row,
-            insert_item=insert_row,
-            summary=rows_summary
-        )
+        try:
+            new_rows = diff_sequence(
+                self.project["rows"],
+                patch_project["rows"],
+                update_item=update_row,
+                delete_item=delete_row,
+                insert_item=insert_row,
+                summary=rows_summary
+            )
+        finally:
+            clear_hash_cache()
         self.project["rows"] = new_rows
 
         if args.write: